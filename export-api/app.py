@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# vim:fileencoding=utf8
+# pylint: disable=missing-docstring
+import csv
+import io
+import json
+import logging
+import os
+import signal
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import psycopg2
+import pyarrow as pa
+import pyarrow.parquet as pq
+from iso8601 import ParseError, parse_date
+
+# Streams Measurement or Bundle history for a set of nodes and a time range
+# as CSV or Parquet. Rows are read through a server-side cursor and written
+# out chunk by chunk (using HTTP chunked encoding), so memory use does not
+# depend on the size of the export.
+
+# Flush the response to the client once this much data was buffered
+RESPONSE_BUFFER_SIZE = 64 * 1024
+
+
+def measurement_row(row):
+    node_id, timestamp, channel_id, data = row
+    return (
+        node_id,
+        timestamp,
+        channel_id,
+        data.get("quantity"),
+        json.dumps(data.get("value")),
+        json.dumps(data),
+    )
+
+
+def bundle_row(row):
+    node_id, timestamp, message_id, data = row
+    return (node_id, timestamp, message_id, json.dumps(data))
+
+
+# Queries are run for one node at a time, so the (node_id, timestamp DESC)
+# index can be walked backwards to get rows in timestamp order, without
+# sorting. Nodes are exported in order, so the result is still sorted by
+# (node_id, timestamp).
+EXPORTS = {
+    "measurements": {
+        "query": """
+            SELECT node_id, timestamp, channel_id, data FROM measurement
+            WHERE node_id = %(node)s
+              AND timestamp >= %(start)s AND timestamp < %(end)s
+            ORDER BY timestamp
+        """,
+        "convert": measurement_row,
+        "schema": pa.schema([
+            ("node_id", pa.string()),
+            ("timestamp", pa.timestamp("us", tz="UTC")),
+            ("channel_id", pa.int32()),
+            ("quantity", pa.string()),
+            ("value", pa.string()),
+            ("data", pa.string()),
+        ]),
+    },
+    "bundles": {
+        "query": """
+            SELECT node_id, timestamp, message_id, data FROM bundle
+            WHERE node_id = %(node)s
+              AND timestamp >= %(start)s AND timestamp < %(end)s
+            ORDER BY timestamp
+        """,
+        "convert": bundle_row,
+        "schema": pa.schema([
+            ("node_id", pa.string()),
+            ("timestamp", pa.timestamp("us", tz="UTC")),
+            ("message_id", pa.string()),
+            ("data", pa.string()),
+        ]),
+    },
+}
+
+
+class ChunkedResponse:
+    """
+    File-like object that writes to a HTTP response using chunked
+    transfer encoding. Small writes are buffered, so the client does not
+    get a chunk for every tiny write done by e.g. the Parquet writer.
+    """
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.buffer = bytearray()
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        if len(self.buffer) >= RESPONSE_BUFFER_SIZE:
+            self.flush()
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        if self.buffer:
+            self.wfile.write(b"%x\r\n" % len(self.buffer))
+            self.wfile.write(self.buffer)
+            self.wfile.write(b"\r\n")
+            self.buffer = bytearray()
+
+    def close(self):
+        if not self.closed:
+            self.flush()
+            self.wfile.write(b"0\r\n\r\n")
+            self.closed = True
+
+
+def open_cursor(conn, export, node, start, end):
+    # A named cursor is a server-side cursor, so rows are only transferred
+    # as they are fetched
+    cursor = conn.cursor(name="export")
+    cursor.itersize = chunk_rows
+    cursor.execute(export["query"], {"node": node, "start": start, "end": end})
+    return cursor
+
+
+def fetch_chunks(conn, export, nodes, start, end, first_cursor):
+    """
+    Yield lists of rows for all nodes. The cursor for the first node is
+    passed in, so errors in opening it can be handled before the response
+    is started.
+    """
+    for i, node in enumerate(nodes):
+        cursor = first_cursor if i == 0 else open_cursor(conn, export, node, start, end)
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_rows)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+
+def write_csv(out, export, chunks):
+    columns = export["schema"].names
+    text = io.StringIO()
+    writer = csv.writer(text)
+    writer.writerow(columns)
+    for rows in chunks:
+        writer.writerows(map(export["convert"], rows))
+        out.write(text.getvalue().encode("utf8"))
+        text.seek(0)
+        text.truncate()
+
+
+def write_parquet(out, export, chunks):
+    schema = export["schema"]
+    with pq.ParquetWriter(pa.PythonFile(out, mode="w"), schema) as writer:
+        # Every chunk becomes a row group
+        for rows in chunks:
+            columns = list(zip(*map(export["convert"], rows)))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(c, type=f.type) for c, f in zip(columns, schema)],
+                schema=schema,
+            ))
+
+
+FORMATS = {
+    "csv": ("text/csv; charset=utf-8", write_csv),
+    "parquet": ("application/vnd.apache.parquet", write_parquet),
+}
+
+
+class ExportHandler(BaseHTTPRequestHandler):
+    # Needed for chunked transfer encoding
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        if len(parts) != 2 or parts[0] != "export" or parts[1] not in EXPORTS:
+            self.send_error(404)
+            return
+        export = EXPORTS[parts[1]]
+
+        params = parse_qs(url.query)
+        nodes = sorted(set(params.get("node", [])))
+        fmt = params.get("format", ["csv"])[0]
+        if not nodes:
+            self.send_error(400, "At least one node parameter is required")
+            return
+        if fmt not in FORMATS:
+            self.send_error(400, "Unknown format: {}".format(fmt))
+            return
+        try:
+            start = parse_date(params["from"][0])
+            end = parse_date(params["to"][0]) if "to" in params else datetime.now(timezone.utc)
+        except KeyError:
+            self.send_error(400, "The from parameter is required")
+            return
+        except ParseError as ex:
+            self.send_error(400, "Invalid timestamp: {}".format(ex))
+            return
+
+        content_type, write = FORMATS[fmt]
+        filename = "{}.{}".format(parts[1], fmt)
+
+        conn = None
+        try:
+            conn = psycopg2.connect(database_url)
+            conn.set_session(readonly=True)
+            first_cursor = open_cursor(conn, export, nodes[0], start, end)
+        except psycopg2.Error as ex:
+            logging.exception("Error starting export: %s", ex)
+            if conn is not None:
+                conn.close()
+            self.send_error(503, "Database unavailable")
+            return
+
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header(
+                "Content-Disposition", 'attachment; filename="{}"'.format(filename)
+            )
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            out = ChunkedResponse(self.wfile)
+            chunks = fetch_chunks(conn, export, nodes, start, end, first_cursor)
+            try:
+                write(out, export, chunks)
+                out.close()
+                logging.info(
+                    "Exported %s %s from %s to %s as %s", parts[1], nodes, start, end, fmt
+                )
+            # pylint: disable=broad-except
+            except Exception as ex:
+                # Headers are already sent, so all we can do is drop the
+                # connection, so the client sees an incomplete response
+                logging.exception("Error during export: %s", ex)
+                self.close_connection = True
+        finally:
+            conn.close()
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+
+def main():
+    global database_url, chunk_rows
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    database_url = os.environ["DATABASE_URL"]
+    chunk_rows = int(os.environ.get("CHUNK_ROWS", 5000))
+    http_port = int(os.environ.get("HTTP_PORT", 8080))
+
+    logging.info("Serving exports on port %s", http_port)
+    server = ThreadingHTTPServer(("", http_port), ExportHandler)
+    # Let server_close() wait for requests that are still running
+    server.daemon_threads = False
+
+    def on_shutdown_signal(signum, frame):
+        logging.info("Received signal %s, shutting down", signum)
+        # If in-flight requests take too long, SIGALRM will kill us
+        signal.alarm(int(os.environ.get("SHUTDOWN_TIMEOUT", 20)))
+        # shutdown() waits for serve_forever() to return, so it cannot be
+        # called from the thread running it
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, on_shutdown_signal)
+    signal.signal(signal.SIGINT, on_shutdown_signal)
+
+    server.serve_forever()
+    server.server_close()
+    logging.info("Shutdown complete")
+
+
+main()
+
+# vim: set sw=4 sts=4 expandtab:
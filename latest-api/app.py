@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# vim:fileencoding=utf8
+# pylint: disable=missing-docstring
+import json
+import logging
+import os
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+import redis
+
+# Serves the latest value per (node, quantity), as maintained in redis by
+# ttn-redis-decoder. This is meant to sit behind nginx, which can cache the
+# responses for CACHE_MAX_AGE seconds and revalidate them using the ETag.
+# The ETag is the version counter bumped by the decoder on every change, so
+# a revalidation costs a single redis GET.
+
+
+def make_latest_key(node_id):
+    return "{}:node:{}".format(latest_prefix, node_id)
+
+
+def decode_node(values):
+    return {
+        name.decode("utf8"): json.loads(value)
+        for name, value in values.items()
+    }
+
+
+def get_all_nodes():
+    node_ids = sorted(
+        n.decode("utf8") for n in redis_server.smembers(latest_prefix + ":nodes")
+    )
+    pipe = redis_server.pipeline()
+    for node_id in node_ids:
+        pipe.hgetall(make_latest_key(node_id))
+    return {
+        node_id: decode_node(values)
+        for node_id, values in zip(node_ids, pipe.execute())
+    }
+
+
+def get_node(node_id):
+    values = redis_server.hgetall(make_latest_key(node_id))
+    if not values:
+        return None
+    return decode_node(values)
+
+
+class LatestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = urlparse(self.path).path.rstrip("/")
+        if path != "/latest" and not path.startswith("/latest/"):
+            self.send_error(404)
+            return
+
+        version = redis_server.get(latest_prefix + ":version") or b"0"
+        etag = 'W/"{}"'.format(version.decode("utf8"))
+        if etag in self.headers.get("If-None-Match", ""):
+            self.send_response(304)
+            self.send_cache_headers(etag)
+            self.end_headers()
+            return
+
+        if path == "/latest":
+            result = get_all_nodes()
+        else:
+            # Node ids contain slashes, so take everything after the prefix
+            result = get_node(unquote(path[len("/latest/"):]))
+            if result is None:
+                self.send_error(404, "Unknown node")
+                return
+
+        body = json.dumps(result).encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_cache_headers(etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_cache_headers(self, etag):
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "public, max-age={}".format(cache_max_age))
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+
+def main():
+    global redis_server, latest_prefix, cache_max_age
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    latest_prefix = os.environ["LATEST_PREFIX"]
+    cache_max_age = int(os.environ.get("CACHE_MAX_AGE", 10))
+    http_port = int(os.environ.get("HTTP_PORT", 8080))
+
+    redis_url = urlparse(os.environ["REDIS_URL"])
+    logging.info(
+        "Connecting Redis to {} on port {}".format(redis_url.hostname, redis_url.port)
+    )
+    redis_server = redis.Redis(
+        host=redis_url.hostname, port=redis_url.port, db=int(redis_url.path[1:] or 0)
+    )
+
+    logging.info("Serving latest values on port %s", http_port)
+    server = ThreadingHTTPServer(("", http_port), LatestHandler)
+    # Let server_close() wait for requests that are still running
+    server.daemon_threads = False
+
+    def on_shutdown_signal(signum, frame):
+        logging.info("Received signal %s, shutting down", signum)
+        # If in-flight requests take too long, SIGALRM will kill us
+        signal.alarm(int(os.environ.get("SHUTDOWN_TIMEOUT", 20)))
+        # shutdown() waits for serve_forever() to return, so it cannot be
+        # called from the thread running it
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, on_shutdown_signal)
+    signal.signal(signal.SIGINT, on_shutdown_signal)
+
+    server.serve_forever()
+    server.server_close()
+    logging.info("Shutdown complete")
+
+
+main()
+
+# vim: set sw=4 sts=4 expandtab:
@@ -0,0 +1,28 @@
+# vim:fileencoding=utf8
+# pylint: disable=missing-docstring
+"""
+Payload format registry and TTN message helpers, shared by
+ttn-redis-decoder, ttn-redis-converter and traffic-replay.
+
+Each supported payload format registers a decoder for an (app, port,
+firmware_version) combination, see registry.py. The built-in formats are
+registered on import, additional ones can be loaded with load_plugins().
+To benchmark all registered decoders, run:
+
+    python -m payload_formats.bench
+"""
+from .registry import (
+    DecodedPayload,
+    InvalidPayload,
+    decoders,
+    load_plugins,
+    lookup,
+    register,
+    samples,
+)
+from .ttn import make_ttn_node_id
+
+# Import built-in formats, so they register themselves
+from . import mjs, mjs_legacy  # noqa: E402,F401  pylint: disable=wrong-import-position
+
+# vim: set sw=4 sts=4 expandtab:
@@ -0,0 +1,29 @@
+# vim:fileencoding=utf8
+# pylint: disable=missing-docstring
+"""
+Benchmark all registered payload decoders against their sample payload.
+Additional plugin modules to load can be passed on the commandline.
+"""
+import sys
+import timeit
+
+from . import decoders, load_plugins, samples
+
+
+def main():
+    load_plugins(sys.argv[1:])
+    for key, decoder in sorted(decoders.items(), key=lambda item: str(item[0])):
+        sample = samples.get(key)
+        if sample is None:
+            print("{}: no sample payload".format(key))
+            continue
+        timer = timeit.Timer(lambda: decoder(sample))
+        number, _ = timer.autorange()
+        best = min(timer.repeat(repeat=5, number=number)) / number
+        print("{}: {:.2f} us per payload".format(key, best * 1e6))
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: set sw=4 sts=4 expandtab:
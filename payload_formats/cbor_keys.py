@@ -0,0 +1,105 @@
+# vim:fileencoding=utf8
+# pylint: disable=missing-docstring
+import logging
+
+# Integer keys and values used to shorten config packets. The node firmware
+# uses the same numbers, so never change existing entries, only add new ones.
+# TODO: Write script to convert below values to a reverse mapping usable in the
+# C++ code.
+CONFIG_PACKET_KEYS = {
+    1: "channel_id",
+    2: "quantity",
+    3: "unit",
+    4: "sensor",
+    5: "item_type",
+    6: "measured",
+    7: "divider",
+}
+
+CONFIG_PACKET_VALUES = {
+    "quantity": {
+        1: "temperature",
+        2: "humidity",
+        3: "voltage",
+        4: "ambient_light",
+        5: "particulate_matter",
+        6: "position",
+    },
+    "unit": {
+        # TODO: How to note these? Perhaps just '°C'?
+        1: "degree_celcius",
+        2: "percent_rh",
+        3: "volt",
+        4: "ug_per_cubic_meter",
+        5: "lux",
+        6: "degrees",
+    },
+    "sensor": {1: "Si2701"},
+    "item_type": {1: "node", 2: "channel"},
+}
+
+CONFIG_PACKET_KEYS_INVERTED = {v: k for k, v in CONFIG_PACKET_KEYS.items()}
+CONFIG_PACKET_VALUES_INVERTED = {
+    outer_k: {v: k for k, v in outer_v.items()}
+    for outer_k, outer_v in CONFIG_PACKET_VALUES.items()
+}
+
+
+def decode_cbor_obj(obj, keys, values):
+    if not isinstance(obj, dict):
+        logging.warning("Element to decode is not object: %s", obj)
+        return obj
+
+    out = {}
+    for key, value in obj.items():
+        if isinstance(key, int):
+            try:
+                key = keys[key]
+            except KeyError:
+                # TODO: Store warnings in output?
+                logging.warning("Unknown integer key in packet: %s=%s", key, value)
+        if isinstance(value, int):
+            values_for_this_key = values.get(key, False)
+            if values_for_this_key:
+                try:
+                    value = values_for_this_key[value]
+                except KeyError:
+                    # TODO: Store warnings in output?
+                    logging.warning(
+                        "Unknown integer value in packet: %s=%s", key, value
+                    )
+        out[key] = value
+    return out
+
+
+def encode_cbor_obj(obj, keys, values):
+    if not isinstance(obj, dict):
+        logging.warning("Element to encode is not object: %s", obj)
+        return obj
+
+    out = {}
+    for key, value in obj.items():
+        if isinstance(value, str):
+            values_for_this_key = values.get(key, False)
+            if values_for_this_key:
+                try:
+                    value = values_for_this_key[value]
+                except KeyError:
+                    pass
+        if isinstance(key, str):
+            try:
+                key = keys[key]
+            except KeyError:
+                pass
+        out[key] = value
+    return out
+
+
+def decode_config_entry(obj):
+    return decode_cbor_obj(obj, CONFIG_PACKET_KEYS, CONFIG_PACKET_VALUES)
+
+
+def encode_config_entry(obj):
+    return encode_cbor_obj(obj, CONFIG_PACKET_KEYS_INVERTED, CONFIG_PACKET_VALUES_INVERTED)
+
+# vim: set sw=4 sts=4 expandtab:
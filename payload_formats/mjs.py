@@ -0,0 +1,39 @@
+# vim:fileencoding=utf8
+# pylint: disable=missing-docstring
+"""
+Native Meet je Stad payload format: CBOR-encoded config packets on port 1
+and data packets on port 2.
+"""
+import logging
+
+import cbor2
+
+from .cbor_keys import decode_config_entry, encode_config_entry
+from .registry import DecodedPayload, register
+
+APP = "mjs"
+CONFIG_PORT = 1
+DATA_PORT = 2
+
+
+@register(APP, CONFIG_PORT, sample=cbor2.dumps([
+    encode_config_entry({"item_type": "node"}),
+    encode_config_entry({
+        "item_type": "channel", "channel_id": 1, "quantity": "temperature",
+        "unit": "degree_celcius", "divider": 16,
+    }),
+]))
+def decode_config(payload):
+    packet = cbor2.loads(payload)
+    if not isinstance(packet, list):
+        logging.warning("Config packet is not list: %s", packet)
+
+    return DecodedPayload(config=list(map(decode_config_entry, packet)))
+
+
+@register(APP, DATA_PORT, sample=cbor2.dumps([{"channel_id": 1, "value": 321}]))
+def decode_data(payload):
+    # TODO Decode shortcuts
+    return DecodedPayload(data=cbor2.loads(payload))
+
+# vim: set sw=4 sts=4 expandtab:
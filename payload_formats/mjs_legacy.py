@@ -0,0 +1,144 @@
+# vim:fileencoding=utf8
+# pylint: disable=missing-docstring
+"""
+Legacy Meet je Stad payload format: fixed bit-packed packets on ports 10,
+11 and 12. These contain no config, so decoding returns the config that
+matches the fields present in the packet.
+"""
+import bitstring
+
+from .registry import DecodedPayload, InvalidPayload, register
+
+APP = "mjs-legacy"
+
+POSITION_CONFIG = {
+    "item_type": "channel",
+    "channel_id": 0,
+    "quantity": "position",
+    "unit": "degrees",
+    "divider": 32768,
+}
+TEMPERATURE_CONFIG = {
+    "item_type": "channel",
+    "channel_id": 1,
+    "quantity": "temperature",
+    "unit": "degrees_celsius",
+    "divider": 16,
+}
+HUMIDITY_CONFIG = {
+    "item_type": "channel",
+    "channel_id": 2,
+    "quantity": "humidity",
+    "unit": "percent_rh",
+    "divider": 16,
+}
+VCC_CONFIG = {
+    "item_type": "channel",
+    "channel_id": 3,
+    "quantity": "voltage",
+    "unit": "volt",
+    "measured": "supply",
+    "divider": 100,
+    "offset": 1,
+}
+BATTERY_CONFIG = {
+    "item_type": "channel",
+    "channel_id": 4,
+    "quantity": "voltage",
+    "unit": "volt",
+    "measured": "battery",
+    "divider": 50,
+    "offset": 1,
+}
+LUX_CONFIG = {
+    "item_type": "channel",
+    "channel_id": 5,
+    "quantity": "ambient_light",
+    "unit": "lux",
+}
+PM25_CONFIG = {
+    "item_type": "channel",
+    "channel_id": 6,
+    "quantity": "particulate_matter",
+    "unit": "ug_per_cubic_meter",
+    "measured:size": 2.5,
+}
+PM10_CONFIG = {
+    "item_type": "channel",
+    "channel_id": 7,
+    "quantity": "particulate_matter",
+    "unit": "ug_per_cubic_meter",
+    "measured:size": 10,
+}
+
+
+def make_decoder(port, lengths, has_firmware, has_lux):
+    """
+    Build the decoder for one port. Everything that only depends on the
+    port is worked out here, once, rather than for every packet.
+    """
+    lengths = frozenset(lengths)
+
+    def decode(payload):
+        if len(payload) not in lengths:
+            raise InvalidPayload(
+                "Invalid packet received on port {} with length {}".format(port, len(payload))
+            )
+
+        stream = bitstring.ConstBitStream(bytes=payload)
+        node_config = {"item_type": "node"}
+        config = [node_config, POSITION_CONFIG, TEMPERATURE_CONFIG, HUMIDITY_CONFIG]
+        data = []
+
+        if has_firmware:
+            node_config["firmware_version"] = stream.read("uint:8")
+
+        # Position
+        data.append({"channel_id": 0, "value": [stream.read("int:24"), stream.read("int:24")]})
+
+        # Temperature
+        data.append({"channel_id": 1, "value": stream.read("int:12")})
+
+        # Humidity
+        data.append({"channel_id": 2, "value": stream.read("int:12")})
+
+        # Always present in newer packets, optional in the oldest
+        if has_firmware or len(stream) - stream.bitpos >= 8:
+            config.append(VCC_CONFIG)
+            data.append({"channel_id": 3, "value": stream.read("uint:8")})
+
+        if has_lux:
+            config.append(LUX_CONFIG)
+            data.append({"channel_id": 5, "value": stream.read("uint:16")})
+
+        if len(stream) - stream.bitpos >= 32:
+            config.append(PM25_CONFIG)
+            data.append({"channel_id": 6, "value": stream.read("uint:16")})
+            config.append(PM10_CONFIG)
+            data.append({"channel_id": 7, "value": stream.read("uint:16")})
+
+        if len(stream) - stream.bitpos >= 8:
+            config.append(BATTERY_CONFIG)
+            data.append({"channel_id": 4, "value": stream.read("uint:8")})
+
+        return DecodedPayload(config=config, data=data)
+
+    return decode
+
+
+# Legacy packet, with optional supply voltage and battery measurement
+register(APP, 10, sample=bytes(11))(
+    make_decoder(10, lengths=(9, 10, 11), has_firmware=False, has_lux=False)
+)
+# Packet without lux, with or without 1 byte battery measurement, with or
+# without 4-byte particulate matter
+register(APP, 11, sample=bytes(16))(
+    make_decoder(11, lengths=(11, 12, 15, 16), has_firmware=True, has_lux=False)
+)
+# Packet with 2-byte lux, with or without 1 byte battery measurement, with or
+# without 4-byte particulate matter
+register(APP, 12, sample=bytes(18))(
+    make_decoder(12, lengths=(13, 14, 17, 18), has_firmware=True, has_lux=True)
+)
+
+# vim: set sw=4 sts=4 expandtab:
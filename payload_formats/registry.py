@@ -0,0 +1,62 @@
+# vim:fileencoding=utf8
+# pylint: disable=missing-docstring
+import importlib
+import logging
+from collections import namedtuple
+
+# Result of decoding a payload. A config payload fills config (a list of
+# config entries), a data payload fills data (a list of channel entries).
+# Some legacy formats contain both.
+DecodedPayload = namedtuple("DecodedPayload", ["config", "data"], defaults=(None, None))
+
+
+class InvalidPayload(ValueError):
+    pass
+
+
+# Maps (app, port, firmware_version) to a decoder function, which takes the
+# raw payload bytes and returns a DecodedPayload. A firmware_version of None
+# is used for decoders that handle any firmware version.
+decoders = {}
+
+# Maps the same keys to an example payload, for benchmarking
+samples = {}
+
+
+def register(app, port, firmware_version=None, sample=None):
+    """
+    Decorator to register a payload decoder. Registering a decoder for a
+    key that already has one replaces it, so plugins can override the
+    built-in decoders.
+    """
+    def decorator(func):
+        key = (app, port, firmware_version)
+        if key in decoders:
+            logging.info("Replacing payload decoder for %s", key)
+        decoders[key] = func
+        if sample is not None:
+            samples[key] = sample
+        return func
+    return decorator
+
+
+def lookup(app, port, firmware_version=None):
+    """
+    Find the decoder for the given app, port and firmware version, falling
+    back to a decoder for any firmware version. Returns None when there is
+    no decoder.
+    """
+    try:
+        return decoders[(app, port, firmware_version)]
+    except KeyError:
+        return decoders.get((app, port, None))
+
+
+def load_plugins(module_names):
+    """Import the given modules, which should register their decoders."""
+    for name in module_names:
+        if name:
+            logging.info("Loading payload format plugin %s", name)
+            importlib.import_module(name)
+
+# vim: set sw=4 sts=4 expandtab:
@@ -0,0 +1,11 @@
+# vim:fileencoding=utf8
+# pylint: disable=missing-docstring
+"""
+Helpers for the messages received from The Things Network.
+"""
+
+
+def make_ttn_node_id(msg):
+    return "ttn/{}/{}".format(msg["app_id"], msg["dev_id"])
+
+# vim: set sw=4 sts=4 expandtab:
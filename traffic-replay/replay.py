@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# vim:fileencoding=utf8
+# pylint: disable=missing-docstring
+"""
+Record production traffic and replay it offline, for capacity testing.
+
+Recordings are zstd-compressed files containing the raw TTN uplink messages
+along with the time they were received. They can be made from a redis
+stream, or from the rawmessage table (including archived messages):
+
+    python replay.py record-stream traffic.rec
+    python replay.py record-stream traffic.rec --follow 3600
+    python replay.py record-db traffic.rec [--from-id ID] [--to-id ID]
+
+And replayed into a redis stream (to load the decoder), or published to an
+MQTT broker such as a local mosquitto standing in for TTN (to load the
+producer or converter):
+
+    python replay.py replay traffic.rec --speed 10 --nodes 1000
+    python replay.py replay traffic.rec --speed max --mqtt localhost:1883
+
+With --nodes N, every message is sent N times, for N different nodes, by
+suffixing the dev_id. No downlinks are ever sent. While replaying, the
+send rate and the length of the target stream are logged every few
+seconds; a stream length that keeps growing means the consumer is
+saturated.
+
+The decoder ignores data messages for nodes without a config, so before
+the first data message of each recorded node, a config message is sent
+for it (or for all of its N nodes), unless the recording already had one
+for that node by then. This is the latest config of the node from before
+the data in the database (when DATABASE_URL is set, which also needs
+ARCHIVE_DIR), or otherwise the first config of the node later in the
+recording. This only applies to the native packet format; the converter
+generates configs for new nodes by itself.
+"""
+import argparse
+import json
+import logging
+import os
+import struct
+import sys
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+import psycopg2
+import redis
+import zstandard
+
+from payload_formats import make_ttn_node_id, mjs
+
+MAGIC = b"MJSREC1\n"
+# received timestamp (unix time), payload length
+RECORD_HEADER = struct.Struct("<dI")
+
+# Seconds between progress reports
+REPORT_INTERVAL = 5
+
+
+def connect_redis():
+    redis_url = urlparse(os.environ["REDIS_URL"])
+    return redis.Redis(
+        host=redis_url.hostname, port=redis_url.port, db=int(redis_url.path[1:] or 0)
+    )
+
+
+def write_recording(filename, messages):
+    """Write (received datetime, payload bytes) tuples to a recording."""
+    count = 0
+    with open(filename, "wb") as f:
+        f.write(MAGIC)
+        with zstandard.ZstdCompressor().stream_writer(f) as writer:
+            for received, payload in messages:
+                writer.write(RECORD_HEADER.pack(received.timestamp(), len(payload)))
+                writer.write(payload)
+                count += 1
+    logging.info("Recorded %s messages to %s", count, filename)
+
+
+def read_recording(filename):
+    """Yield (unix timestamp, payload bytes) tuples from a recording."""
+    with open(filename, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not a recording: {}".format(filename))
+        with zstandard.ZstdDecompressor().stream_reader(f) as reader:
+            while True:
+                header = reader.read(RECORD_HEADER.size)
+                if not header:
+                    return
+                timestamp, length = RECORD_HEADER.unpack(header)
+                yield timestamp, reader.read(length)
+
+
+def stream_messages(redis_server, stream, follow):
+    def convert(fields):
+        received = datetime.fromisoformat(fields[b"timestamp"].decode("utf8"))
+        return received, fields[b"payload"]
+
+    # First whatever is currently in the stream (without removing it)
+    last_id = "0"
+    for entry_id, fields in redis_server.xrange(stream):
+        last_id = entry_id
+        yield convert(fields)
+
+    # Then, new entries as they come in
+    end = time.monotonic() + follow
+    while time.monotonic() < end:
+        block = max(1, int((end - time.monotonic()) * 1000))
+        for _, entries in redis_server.xread({stream: last_id}, block=block):
+            for entry_id, fields in entries:
+                last_id = entry_id
+                yield convert(fields)
+
+
+def db_messages(from_id, to_id):
+    # Shared with the decoder, so archived messages can be recorded too
+    import archive  # pylint: disable=import-outside-toplevel
+
+    for msg in archive.iter_raw_messages(
+            os.environ["DATABASE_URL"], os.environ["ARCHIVE_DIR"], from_id, to_id
+    ):
+        if msg["src"] != "ttn" or not msg["raw"]:
+            continue
+        received = msg["received_from_src"] or datetime.now(timezone.utc)
+        yield received, msg["raw"]
+
+
+def synthesize(msg, payload, nodes):
+    """Yield (message, payload) for each of the given number of nodes."""
+    if nodes == 1:
+        yield msg, payload
+        return
+    msg = dict(msg)
+    dev_id = msg["dev_id"]
+    for i in range(nodes):
+        msg["dev_id"] = "{}-sim{}".format(dev_id, i)
+        yield msg, json.dumps(msg).encode("utf8")
+
+
+def recorded_configs(filename):
+    """Return the first config message of each node in a recording."""
+    configs = {}
+    for _, payload in read_recording(filename):
+        try:
+            msg = json.loads(payload.decode("utf8"))
+            if msg["port"] == mjs.CONFIG_PORT:
+                configs.setdefault(make_ttn_node_id(msg), msg)
+        except (ValueError, KeyError):
+            continue
+    return configs
+
+
+def db_config(database_url, archive_dir, node_id, before):
+    """
+    Return the latest config message of a node in the database from before
+    the given time, if any.
+    """
+    # Shared with the decoder, so archived messages can be used too
+    import archive  # pylint: disable=import-outside-toplevel
+
+    conn = psycopg2.connect(database_url)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT "src" FROM "config"
+                WHERE "node_id" = %s AND "timestamp" <= %s::timestamptz
+                ORDER BY "timestamp" DESC LIMIT 1
+            """, (node_id, before))
+            row = cursor.fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+
+    for msg in archive.iter_raw_messages(database_url, archive_dir, row[0], row[0]):
+        if msg["raw"]:
+            return json.loads(msg["raw"].decode("utf8"))
+    return None
+
+
+def find_config(node_id, data_time, configs, database_url, archive_dir):
+    """
+    Return a config message to send before a data message (sent at
+    data_time) of a node that has not had a config yet, or None when there
+    is none.
+    """
+    config = None
+    if database_url:
+        config = db_config(database_url, archive_dir, node_id, data_time)
+    if config is None and node_id in configs:
+        config = dict(configs[node_id])
+        # The decoder only uses configs from before the data, so pretend it
+        # was sent just before
+        config["metadata"] = dict(config["metadata"], time=data_time)
+    return config
+
+
+def make_sender(args):
+    if args.mqtt:
+        # Imported here, so paho is only needed when publishing to MQTT
+        import paho.mqtt.client as mqtt  # pylint: disable=import-outside-toplevel
+
+        host, _, port = args.mqtt.partition(":")
+        client = mqtt.Client()
+        client.connect(host, port=int(port or 1883))
+        client.loop_start()
+
+        def send(msg, payload):
+            topic = "{}/devices/{}/up".format(msg["app_id"], msg["dev_id"])
+            client.publish(topic, payload)
+
+        def lag():
+            return None
+
+        return send, lag
+
+    redis_server = connect_redis()
+    stream = args.stream or os.environ["REDIS_STREAM"]
+
+    def send(msg, payload):  # pylint: disable=unused-argument
+        redis_server.xadd(stream, {
+            "payload": payload,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+        })
+
+    def lag():
+        return redis_server.xlen(stream)
+
+    return send, lag
+
+
+def replay(args):
+    speed = None if args.speed == "max" else float(args.speed)
+    database_url = os.environ.get("DATABASE_URL")
+    archive_dir = os.environ.get("ARCHIVE_DIR")
+    if database_url and not archive_dir:
+        sys.exit("ARCHIVE_DIR must be set to look up configs in the database")
+
+    send, lag = make_sender(args)
+    configs = recorded_configs(args.recording)
+    # Recorded nodes for which a config was sent
+    configured = set()
+
+    start = time.monotonic()
+    first_timestamp = None
+    sent = 0
+    node_ids = set()
+    last_report = start
+    sent_at_last_report = 0
+
+    for timestamp, payload in read_recording(args.recording):
+        if first_timestamp is None:
+            first_timestamp = timestamp
+        if speed is not None:
+            delay = start + (timestamp - first_timestamp) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        try:
+            msg = json.loads(payload.decode("utf8"))
+            node_id = make_ttn_node_id(msg)
+            port = msg["port"]
+            msg_time = msg["metadata"]["time"]
+        except (ValueError, KeyError, TypeError) as ex:
+            logging.warning("Skipping invalid recorded message: %s", ex)
+            continue
+
+        if port == mjs.CONFIG_PORT:
+            configured.add(node_id)
+        elif port == mjs.DATA_PORT and node_id not in configured:
+            configured.add(node_id)
+            config = find_config(node_id, msg_time, configs, database_url, archive_dir)
+            if config is None:
+                logging.warning("No config found for %s, its data will be ignored", node_id)
+            else:
+                config_payload = json.dumps(config).encode("utf8")
+                for config_msg, node_payload in synthesize(config, config_payload, args.nodes):
+                    send(config_msg, node_payload)
+                    sent += 1
+
+        for msg, node_payload in synthesize(msg, payload, args.nodes):
+            send(msg, node_payload)
+            node_ids.add(make_ttn_node_id(msg))
+            sent += 1
+
+        now = time.monotonic()
+        if now - last_report >= REPORT_INTERVAL:
+            logging.info(
+                "Sent %s messages (%.1f/s), stream length %s",
+                sent, (sent - sent_at_last_report) / (now - last_report), lag(),
+            )
+            last_report = now
+            sent_at_last_report = sent
+
+    elapsed = time.monotonic() - start
+    logging.info(
+        "Replayed %s messages for %s nodes in %.1fs (%.1f/s), stream length %s",
+        sent, len(node_ids), elapsed, sent / elapsed if elapsed else 0, lag(),
+    )
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record_stream = commands.add_parser("record-stream", help="record from a redis stream")
+    record_stream.add_argument("recording")
+    record_stream.add_argument("--stream", help="defaults to REDIS_STREAM")
+    record_stream.add_argument(
+        "--follow", type=float, default=0,
+        help="keep recording new entries for this many seconds",
+    )
+
+    record_db = commands.add_parser("record-db", help="record from the rawmessage table")
+    record_db.add_argument("recording")
+    record_db.add_argument("--from-id", type=int, default=0)
+    record_db.add_argument("--to-id", type=int)
+
+    replay_cmd = commands.add_parser("replay", help="replay a recording")
+    replay_cmd.add_argument("recording")
+    replay_cmd.add_argument(
+        "--speed", default="1", help="speedup relative to the recording, or max",
+    )
+    replay_cmd.add_argument(
+        "--nodes", type=int, default=1, help="number of nodes to send each message for",
+    )
+    replay_cmd.add_argument("--stream", help="defaults to REDIS_STREAM")
+    replay_cmd.add_argument("--mqtt", metavar="HOST[:PORT]", help="publish to MQTT instead")
+
+    args = parser.parse_args()
+    if args.command == "record-stream":
+        stream = args.stream or os.environ["REDIS_STREAM"]
+        write_recording(args.recording, stream_messages(connect_redis(), stream, args.follow))
+    elif args.command == "record-db":
+        write_recording(args.recording, db_messages(args.from_id, args.to_id))
+    else:
+        replay(args)
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: set sw=4 sts=4 expandtab:
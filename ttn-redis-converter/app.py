@@ -5,6 +5,7 @@
 from datetime import datetime, timezone
 import logging
 import os
+import signal
 import json
 import base64
 import traceback
@@ -13,79 +14,15 @@ from urllib.parse import urlparse
 import redis
 
 import paho.mqtt.client as mqtt
-import bitstring
 import cbor2
 
-CONFIG_PORT = 1
-DATA_PORT = 2
-
-# Copied from ttn-redis-decoder, do not modify here
-CONFIG_PACKET_KEYS = {
-    1: "channel_id",
-    2: "quantity",
-    3: "unit",
-    4: "sensor",
-    5: "item_type",
-    6: "measured",
-    7: "divider",
-}
-
-# Copied from ttn-redis-decoder, do not modify here
-CONFIG_PACKET_VALUES = {
-    "quantity": {
-        1: "temperature",
-        2: "humidity",
-        3: "voltage",
-        4: "ambient_light",
-        5: "particulate_matter",
-        6: "position",
-    },
-    "unit": {
-        # TODO: How to note these? Perhaps just '°C'?
-        1: "degrees_celcius",
-        2: "percent_rh",
-        3: "volt",
-        4: "ug_per_cubic_meter",
-        5: "lux",
-        6: "degrees",
-    },
-    "sensor": {1: "Si2701"},
-    "item_type": {1: "node", 2: "channel"},
-}
-
-CONFIG_PACKET_KEYS_INVERTED = {v: k for k, v in CONFIG_PACKET_KEYS.items()}
-CONFIG_PACKET_VALUES_INVERTED = {
-    outer_k: {v: k for k, v in outer_v.items()}
-    for outer_k, outer_v in CONFIG_PACKET_VALUES.items()
-}
-
-
-def encode_cbor_obj(obj, keys, values):
-    if not isinstance(obj, dict):
-        logging.warning("Element to encode is not object: %s", obj)
-        return obj
-
-    out = {}
-    for key, value in obj.items():
-        if isinstance(value, str):
-            values_for_this_key = values.get(key, False)
-            if values_for_this_key:
-                try:
-                    value = values_for_this_key[value]
-                except KeyError:
-                    pass
-        if isinstance(key, str):
-            try:
-                key = keys[key]
-            except KeyError:
-                pass
-        out[key] = value
-    return out
-
-
-# Copied from ttn-redis-decoder
-def make_ttn_node_id(msg):
-    return "ttn/{}/{}".format(msg["app_id"], msg["dev_id"])
+import payload_formats
+from payload_formats import make_ttn_node_id, mjs, mjs_legacy
+from payload_formats.cbor_keys import encode_config_entry
+
+# Format of the packets received by the converter (the format of the
+# produced packets is fixed, see produce_message)
+PAYLOAD_APP = mjs_legacy.APP
 
 
 # Maps station ids to the last frame counter seen
@@ -93,132 +30,19 @@ last_counter_seen = {}
 
 
 def process_data(msg_obj, payload):
-    stream = bitstring.ConstBitStream(bytes=payload)
-
-    node_config = {"item_type": "node"}
-    config = [
-        node_config,
-        {
-            "item_type": "channel",
-            "channel_id": 0,
-            "quantity": "position",
-            "unit": "degrees",
-            "divider": 32768,
-        },
-        {
-            "item_type": "channel",
-            "channel_id": 1,
-            "quantity": "temperature",
-            "unit": "degrees_celsius",
-            "divider": 16,
-        },
-        {
-            "item_type": "channel",
-            "channel_id": 2,
-            "quantity": "humidity",
-            "unit": "percent_rh",
-            "divider": 16,
-        },
-    ]
-    vcc_config = {
-        "item_type": "channel",
-        "channel_id": 3,
-        "quantity": "voltage",
-        "unit": "volt",
-        "measured": "supply",
-        "divider": 100,
-        "offset": 1,
-    }
-    battery_config = {
-        "item_type": "channel",
-        "channel_id": 4,
-        "quantity": "voltage",
-        "unit": "volt",
-        "measured": "battery",
-        "divider": 50,
-        "offset": 1,
-    }
-    lux_config = {
-        "item_type": "channel",
-        "channel_id": 5,
-        "quantity": "ambient_light",
-        "unit": "lux",
-    }
-    pm25_config = {
-        "item_type": "channel",
-        "channel_id": 6,
-        "quantity": "particulate_matter",
-        "unit": "ug_per_cubic_meter",
-        "measured:size": 2.5,
-    }
-    pm10_config = {
-        "item_type": "channel",
-        "channel_id": 7,
-        "quantity": "particulate_matter",
-        "unit": "ug_per_cubic_meter",
-        "measured:size": 10,
-    }
-
-    data = []
-
     port = msg_obj["port"]
-    length = len(payload)
-    if port == 10:
-        # Legacy packet
-        if length < 9 or length > 11:
-            logging.warning(
-                "Invalid packet received on port %s with length %s", port, length
-            )
-            return
-    elif port == 11:
-        # Packet without lux, with or without 1 byte battery measurement, with
-        # or without 4-byte particulate matter
-        if length < 11 or 12 < length < 15 or length > 16:
-            logging.warning(
-                "Invalid packet received on port %s with length %s", port, length
-            )
-            return
-    elif port == 12:
-        # Packet with 2-byte lux, with or without 1 byte battery measurement, with or
-        # without 4-byte particulate matter
-        if length < 13 or 14 < length < 17 or length > 18:
-            logging.warning(
-                "Invalid packet received on port %s with length %s", port, length
-            )
-            return
-    else:
+    decoder = payload_formats.lookup(PAYLOAD_APP, port)
+    if decoder is None:
         logging.warning("Ignoring message with unknown port: %s", port)
         return
 
-    if port != 10:
-        node_config["firmware_version"] = stream.read("uint:8")
-
-    # Position
-    data.append({"channel_id": 0, "value": [stream.read("int:24"), stream.read("int:24")]})
-
-    # Temperature
-    data.append({"channel_id": 1, "value": stream.read("int:12")})
-
-    # Humidity
-    data.append({"channel_id": 2, "value": stream.read("int:12")})
-
-    if port >= 11 or len(stream) - stream.bitpos >= 8:
-        config.append(vcc_config)
-        data.append({"channel_id": 3, "value": stream.read("uint:8")})
-
-    if port == 12:
-        config.append(lux_config)
-        data.append({"channel_id": 5, "value": stream.read("uint:16")})
-
-    if len(stream) - stream.bitpos >= 32:
-        config.append(pm25_config)
-        data.append({"channel_id": 6, "value": stream.read("uint:16")})
-        config.append(pm10_config)
-        data.append({"channel_id": 7, "value": stream.read("uint:16")})
-
-    if len(stream) - stream.bitpos >= 8:
-        config.append(battery_config)
-        data.append({"channel_id": 4, "value": stream.read("uint:8")})
+    try:
+        decoded = decoder(payload)
+    except payload_formats.InvalidPayload as ex:
+        logging.warning("%s", ex)
+        return
+    config = decoded.config
+    data = decoded.data
 
     node_id = make_ttn_node_id(msg_obj)
     msg_counter = msg_obj["counter"]
@@ -237,17 +61,12 @@ def process_data(msg_obj, payload):
     if generate_config:
         logging.debug("Generated config payload (before shortening): %s", config)
 
-        def encode(item):
-            return encode_cbor_obj(
-                item, CONFIG_PACKET_KEYS_INVERTED, CONFIG_PACKET_VALUES_INVERTED
-            )
-
-        config = list(map(encode, config))
+        config = list(map(encode_config_entry, config))
         logging.debug("Generated config payload (after shortening): %s", config)
-        yield produce_message(msg_obj, config, CONFIG_PORT)
+        yield produce_message(msg_obj, config, mjs.CONFIG_PORT)
 
     logging.debug("Generated data payload: %s", data)
-    yield produce_message(msg_obj, data, DATA_PORT)
+    yield produce_message(msg_obj, data, mjs.DATA_PORT)
 
 
 def produce_message(msg_obj, payload, port):
@@ -310,12 +129,16 @@ def main():
 
     logging.basicConfig(level=logging.DEBUG)
 
+    payload_formats.load_plugins(os.environ.get("PAYLOAD_FORMAT_PLUGINS", "").split(","))
+
     redis_stream = os.environ["REDIS_STREAM"]
     app_id = os.environ.get("TTN_CONVERT_APP_ID")
     access_key = get_env_or_file("TTN_CONVERT_ACCESS_KEY")
     ttn_host = os.environ.get("TTN_HOST", "eu.thethings.network")
     ca_cert_path = os.environ.get("TTN_CA_CERT_PATH", "mqtt-ca.pem")
-    ttn_port = 8883
+    # An empty TTN_CA_CERT_PATH disables TLS, e.g. to connect to a local
+    # mosquitto for load testing
+    ttn_port = int(os.environ.get("TTN_PORT", 8883 if ca_cert_path else 1883))
 
     redis_url = urlparse(os.environ["REDIS_URL"])
     logging.info(
@@ -330,9 +153,24 @@ def main():
     mqtt_client.on_connect = on_connect
     mqtt_client.on_message = on_message
     mqtt_client.username_pw_set(app_id, password=access_key)
-    mqtt_client.tls_set(ca_cert_path)
+    if ca_cert_path:
+        mqtt_client.tls_set(ca_cert_path)
     mqtt_client.connect(ttn_host, port=ttn_port)
+
+    # Messages are handled synchronously from within the network loop, so
+    # after disconnecting, loop_forever() returns only after the current
+    # message was added to redis.
+    def on_shutdown_signal(signum, frame):
+        logging.info("Received signal %s, shutting down", signum)
+        # If the pending work cannot be finished in time, SIGALRM will kill us
+        signal.alarm(int(os.environ.get("SHUTDOWN_TIMEOUT", 20)))
+        mqtt_client.disconnect()
+
+    signal.signal(signal.SIGTERM, on_shutdown_signal)
+    signal.signal(signal.SIGINT, on_shutdown_signal)
+
     mqtt_client.loop_forever()
+    logging.info("Shutdown complete")
 
 
 main()
@@ -6,16 +6,25 @@ import itertools
 import json
 import logging
 import os
-from datetime import datetime
+import signal
+import time
+import traceback
+from datetime import datetime, timezone
 from urllib.parse import urlparse
 
-import cbor2
 import elasticsearch
+import psycopg2
 import redis
-from iso8601 import parse_date
+from iso8601 import ParseError, parse_date
+from psycopg2.extras import execute_values
 from pony import orm
 from pony.orm import desc, max
 
+import payload_formats
+from payload_formats import make_ttn_node_id
+import schema
+from batching import BatchController
+
 database_url = urlparse(os.environ["DATABASE_URL"])
 redis_url = urlparse(os.environ["REDIS_URL"])
 
@@ -43,7 +52,10 @@ class RawMessage(db.Entity):
 
     received_from_src = orm.Optional(datetime, sql_type='TIMESTAMP WITH TIME ZONE')
     raw = orm.Optional(bytes)
-    decoded = orm.Optional(orm.Json)
+    decoded = orm.Optional(orm.Json, nullable=True)
+    # When set, raw and decoded were moved to this archive segment, see
+    # archive.py
+    archive_segment = orm.Optional(str, nullable=True)
 
     configs = orm.Set("Config")
     bundles = orm.Set("Bundle")
@@ -84,7 +96,10 @@ class Measurement(db.Entity):
     data = orm.Required(orm.Json)
 
 
-db.generate_mapping(create_tables=True)
+# Tables and indexes are managed by versioned migrations, rather than
+# letting pony create the tables.
+schema.migrate(os.environ["DATABASE_URL"])
+db.generate_mapping(create_tables=False)
 
 def delete_if_exists(entity, **kwargs):
     # This runs a DELETE query without creating an instance. This bypasses the
@@ -123,30 +138,42 @@ def process_message(entry_id, message):
         logging.warning(ex)
         return
 
+    # Gateway metadata is stored separately, in the reception table, so
+    # leave it out of the decoded version (and elasticsearch). It is of
+    # course still available in the raw payload.
+    gateways = msg_obj.get("metadata", {}).pop("gateways", [])
+
     # Store the "decoded" JSON version, which is a bit more readable for debugging
     raw_msg.decoded = msg_obj
     orm.commit()
 
+    queue_receptions(raw_msg, msg_obj, gateways)
+
+    # Any other error is left to the main loop, which retries the message
+    # and eventually moves it to the dead letter stream
     try:
         decode_message(raw_msg, msg_obj, payload)
-    # pylint: disable=broad-except
-    except Exception as ex:
-        logging.exception("Error processing packet: %s", ex)
-        return
+    except payload_formats.InvalidPayload as ex:
+        # Retrying will not help for these
+        logging.warning("Invalid payload: %s", ex)
+
+
+# Format of the packets in the stream (legacy packets are converted to this
+# format by ttn-redis-converter)
+PAYLOAD_APP = payload_formats.mjs.APP
 
 
 def decode_message(raw_msg, msg, payload):
     port = msg["port"]
-    if port == 1:
-        return decode_config_message(raw_msg, msg, payload)
-    if port == 2:
-        return decode_data_message(raw_msg, msg, payload)
-    logging.warning("Ignoring message with unknown port: %s", port)
-    return None
-
+    decoder = payload_formats.lookup(PAYLOAD_APP, port)
+    if decoder is None:
+        logging.warning("Ignoring message with unknown port: %s", port)
+        return None
 
-def make_ttn_node_id(msg):
-    return "ttn/{}/{}".format(msg["app_id"], msg["dev_id"])
+    decoded = decoder(payload)
+    if decoded.config is not None:
+        return decode_config_message(raw_msg, msg, decoded.config)
+    return decode_data_message(raw_msg, msg, decoded.data)
 
 
 def make_msg_id(node_id, msg):
@@ -157,20 +184,13 @@ def make_meas_id(msg_id, chan_id):
     return "{}/{}".format(msg_id, chan_id)
 
 
-def decode_config_message(raw_msg, msg, payload):
-    entries = decode_config_packet(payload)
+def decode_config_message(raw_msg, msg, entries):
     logging.debug("Decoded config entries: %s", entries)
     config_entries = decode_config_entries(entries)
 
     node_id = make_ttn_node_id(msg)
     msg_id = make_msg_id(node_id, msg)
 
-    # HACK: Elasticsearch breaks if a field is sometimes a timestamp and
-    # sometimes the empty string, so remove empty time fields for now...
-    for gw_data in msg.get("metadata", {}).get("gateways", []):
-        if "time" in gw_data and not gw_data["time"]:
-            gw_data.pop("time")
-
     delete_if_exists(Config, message_id=msg_id)
     config = Config(
         message_id=msg_id,
@@ -195,17 +215,6 @@ def decode_config_message(raw_msg, msg, payload):
     return config
 
 
-def decode_config_packet(payload):
-    packet = cbor2.loads(payload)
-    if not isinstance(packet, list):
-        logging.warning("Config packet is not list: %s", packet)
-
-    def decode(obj):
-        return decode_cbor_obj(obj, CONFIG_PACKET_KEYS, CONFIG_PACKET_VALUES)
-
-    return list(map(decode, packet))
-
-
 def decode_config_entries(entries):
     channels = {}
     node = {}
@@ -235,9 +244,7 @@ def decode_config_entries(entries):
     return message
 
 
-def decode_data_message(raw_msg, msg, payload):
-    # TODO Decode shortcuts
-    entries = cbor2.loads(payload)
+def decode_data_message(raw_msg, msg, entries):
     logging.debug("Decoded data entries: %s", entries)
 
     node_id = make_ttn_node_id(msg)
@@ -259,12 +266,6 @@ def decode_data_message(raw_msg, msg, payload):
     channels = decode_data_entries(entries, config)
     logging.debug("Decoded data: %s", channels)
 
-    # HACK: Elasticsearch breaks if a field is sometimes a timestamp and
-    # sometimes the empty string, so remove empty time fields for now...
-    for gw_data in msg.get("metadata", {}).get("gateways", []):
-        if "time" in gw_data and not gw_data["time"]:
-            gw_data.pop("time")
-
     delete_if_exists(Bundle, message_id=msg_id)
     bundle = Bundle(
         config=config,
@@ -314,9 +315,145 @@ def decode_data_message(raw_msg, msg, payload):
             }
             es.index(index="data_single", id=meas_id, body=body)
 
+    # Only publish to the latest-value cache once the measurements are
+    # actually stored, so the cache never runs ahead of the database
+    orm.commit()
+    update_latest_cache(node_id, timestamp, channels)
+
     return bundle
 
 
+# Receptions waiting to be written to the database, as tuples of
+# (src, node_id, timestamp, gateway id, rssi, snr, channel, time)
+pending_receptions = []
+
+# Maps gateway ids (as used by TTN) to the id in the gateway table
+gateway_ids = {}
+
+
+def queue_receptions(raw_msg, msg, gateways):
+    try:
+        node_id = make_ttn_node_id(msg)
+        timestamp = parse_date(msg["metadata"]["time"])
+    except (KeyError, ParseError) as ex:
+        logging.warning("Cannot store receptions for message without %s", ex)
+        return
+
+    for gw_data in gateways:
+        try:
+            gw_time = parse_date(gw_data["time"]) if gw_data.get("time") else None
+        except ParseError:
+            gw_time = None
+        pending_receptions.append((
+            raw_msg.id,
+            node_id,
+            timestamp,
+            gw_data.get("gtw_id"),
+            gw_data.get("rssi"),
+            gw_data.get("snr"),
+            gw_data.get("channel"),
+            gw_time,
+        ))
+
+
+def intern_gateway(cursor, gtw_id):
+    try:
+        return gateway_ids[gtw_id]
+    except KeyError:
+        # The dummy update makes RETURNING also work for existing rows
+        cursor.execute("""
+            INSERT INTO "gateway" ("gtw_id") VALUES (%s)
+            ON CONFLICT ("gtw_id") DO UPDATE SET "gtw_id" = EXCLUDED."gtw_id"
+            RETURNING "id"
+        """, (gtw_id,))
+        gateway_ids[gtw_id] = cursor.fetchone()[0]
+        return gateway_ids[gtw_id]
+
+
+@orm.db_session
+def flush_receptions():
+    """
+    Write all pending receptions to the database in a single insert. On
+    errors, the receptions are kept, to be written by the next flush.
+    """
+    if not pending_receptions:
+        return
+
+    # This bypasses pony, since it has no support for bulk inserts
+    conn = db.get_connection()
+    cursor = conn.cursor()
+    try:
+        rows = [
+            (src, node_id, timestamp, intern_gateway(cursor, gtw_id or ""), rssi, snr, channel, time)
+            for src, node_id, timestamp, gtw_id, rssi, snr, channel, time in pending_receptions
+        ]
+        # A raw message can be deleted (because it was reprocessed) before
+        # its receptions are written, so skip those. The reprocessing
+        # queues new receptions for the new raw message.
+        execute_values(cursor, """
+            INSERT INTO "reception"
+                ("src", "node_id", "timestamp", "gateway", "rssi", "snr", "channel", "time")
+            SELECT * FROM (VALUES %s) AS "v"
+                ("src", "node_id", "timestamp", "gateway", "rssi", "snr", "channel", "time")
+            WHERE EXISTS (SELECT 1 FROM "rawmessage" WHERE "rawmessage"."id" = "v"."src")
+        """, rows, template="""(
+            %s::integer, %s::text, %s::timestamptz, %s::integer,
+            %s::real, %s::real, %s::smallint, %s::timestamptz
+        )""")
+        conn.commit()
+        logging.debug("Stored %s receptions", len(rows))
+    except psycopg2.Error:
+        conn.rollback()
+        # Any gateways interned in this transaction are gone as well
+        gateway_ids.clear()
+        raise
+    pending_receptions.clear()
+
+
+def make_latest_key(node_id):
+    return "{}:node:{}".format(latest_prefix, node_id)
+
+
+def update_latest_cache(node_id, timestamp, channels):
+    """
+    Update the per-(node, quantity) latest-value hash in redis.
+
+    Each node gets a hash keyed by quantity name (as used in the
+    bundle's channels), containing a JSON object with the timestamp and
+    decoded data. Values are only overwritten by newer measurements, so
+    replaying old messages does not make the cache go back in time. A
+    version counter is bumped on every change, which the latest-api
+    service uses as its ETag.
+    """
+    if not latest_prefix or not channels:
+        return
+
+    key = make_latest_key(node_id)
+    names = list(channels)
+    current = redis_server.hmget(key, names)
+
+    updates = {}
+    for name, cached in zip(names, current):
+        if cached is not None:
+            cached_timestamp = parse_date(json.loads(cached)["timestamp"])
+            if cached_timestamp >= timestamp:
+                continue
+        updates[name] = json.dumps({
+            "timestamp": timestamp.isoformat(),
+            "data": channels[name],
+        })
+
+    if not updates:
+        return
+
+    pipe = redis_server.pipeline()
+    pipe.hset(key, mapping=updates)
+    pipe.sadd(latest_prefix + ":nodes", node_id)
+    pipe.incr(latest_prefix + ":version")
+    pipe.execute()
+    logging.debug("Updated latest values for %s: %s", node_id, list(updates))
+
+
 def decode_data_entries(entries, config: Config):
     channels = {}
 
@@ -381,70 +518,99 @@ def decode_data_entry(chan_data, chan_config):
     return data
 
 
-# TODO: Write script to convert below values to a reverse mapping usable in the
-# C++ code.
-CONFIG_PACKET_KEYS = {
-    1: "channel_id",
-    2: "quantity",
-    3: "unit",
-    4: "sensor",
-    5: "item_type",
-    6: "measured",
-    7: "divider",
-}
-
-CONFIG_PACKET_VALUES = {
-    "quantity": {
-        1: "temperature",
-        2: "humidity",
-        3: "voltage",
-        4: "ambient_light",
-        5: "particulate_matter",
-        6: "position",
-    },
-    "unit": {
-        # TODO: How to note these? Perhaps just '°C'?
-        1: "degree_celcius",
-        2: "percent_rh",
-        3: "volt",
-        4: "ug_per_cubic_meter",
-        5: "lux",
-        6: "degrees",
-    },
-    "sensor": {1: "Si2701"},
-    "item_type": {1: "node", 2: "channel"},
-}
-
-
-def decode_cbor_obj(obj, keys, values):
-    if not isinstance(obj, dict):
-        logging.warning("Element to decode is not object: %s", obj)
-        return obj
-
-    out = {}
-    for key, value in obj.items():
-        if isinstance(key, int):
-            try:
-                key = keys[key]
-            except KeyError:
-                # TODO: Store warnings in output?
-                logging.warning("Unknown integer key in packet: %s=%s", key, value)
-        if isinstance(value, int):
-            values_for_this_key = values.get(key, False)
-            if values_for_this_key:
-                try:
-                    value = values_for_this_key[value]
-                except KeyError:
-                    # TODO: Store warnings in output?
-                    logging.warning(
-                        "Unknown integer value in packet: %s=%s", key, value
-                    )
-        out[key] = value
-    return out
+def get_retry_states(entry_ids):
+    """Return the retry state for those of the given entries that failed before."""
+    if not entry_ids:
+        return {}
+    states = redis_server.hmget(retries_key, entry_ids)
+    return {
+        entry_id: json.loads(state)
+        for entry_id, state in zip(entry_ids, states)
+        if state is not None
+    }
+
+
+def record_failure(stream_name, entry_id, message, ex, state):
+    """
+    Schedule a failed entry for retry with exponential backoff, or move it
+    to the dead letter stream after MAX_ATTEMPTS attempts. Returns the time
+    of the next attempt, or None when the entry was given up on.
+    """
+    attempts = (state["attempts"] if state else 0) + 1
+    if attempts >= max_attempts:
+        logging.error(
+            "Giving up on message %s after %s attempts, moving to %s",
+            entry_id, attempts, dead_letter_stream,
+        )
+        fields = dict(message)
+        fields.update({
+            "entry_id": entry_id,
+            "stream": stream_name,
+            "attempts": attempts,
+            "error": repr(ex),
+            "traceback": traceback.format_exc(),
+            "failed_at": datetime.now(timezone.utc).isoformat(),
+        })
+        pipe = redis_server.pipeline()
+        pipe.xadd(dead_letter_stream, fields)
+        pipe.xdel(stream_name, entry_id)
+        pipe.hdel(retries_key, entry_id)
+        pipe.execute()
+        return None
+
+    delay = min(retry_backoff * 2 ** (attempts - 1), RETRY_BACKOFF_MAX)
+    retry_at = time.time() + delay
+    logging.warning("Will retry message %s in %s seconds (attempt %s)", entry_id, delay, attempts)
+    redis_server.hset(retries_key, entry_id, json.dumps({
+        "attempts": attempts,
+        "retry_at": retry_at,
+        "error": repr(ex),
+    }))
+    return retry_at
+
+
+# Never wait longer than this between retries
+RETRY_BACKOFF_MAX = 3600
+
+# Errors that mean a service we depend on is unavailable, rather than that
+# something is wrong with the message being processed. These do not count
+# as failed attempts, instead the main loop pauses until the service is
+# back, with exponential backoff up to OUTAGE_BACKOFF_MAX seconds.
+TRANSIENT_ERRORS = (
+    psycopg2.OperationalError,
+    orm.OperationalError,
+    redis.ConnectionError,
+    redis.TimeoutError,
+    elasticsearch.ConnectionError,
+)
+OUTAGE_BACKOFF_MIN = 1
+OUTAGE_BACKOFF_MAX = 60
+
+
+class ShutdownRequested(Exception):
+    pass
+
+
+# Set when a shutdown was requested, checked between messages
+stopping = False
+# Set while blocked waiting for new messages (or for an outage to pass), so
+# there is nothing to drain
+waiting = False
+
+
+def handle_shutdown_signal(signum, frame):
+    global stopping
+    logging.info("Received signal %s, shutting down", signum)
+    stopping = True
+    # If draining takes too long, SIGALRM will kill us
+    signal.alarm(shutdown_timeout)
+    if waiting:
+        raise ShutdownRequested()
 
 
 def main():
-    global es
+    global es, redis_server, latest_prefix, shutdown_timeout, waiting
+    global retries_key, dead_letter_stream, max_attempts, retry_backoff
 
     logging.basicConfig(level=logging.DEBUG)
 
@@ -457,6 +623,17 @@ def main():
         host=redis_url.hostname, port=redis_url.port, db=int(redis_url.path[1:] or 0)
     )
 
+    latest_prefix = os.environ.get("LATEST_PREFIX")
+
+    payload_formats.load_plugins(os.environ.get("PAYLOAD_FORMAT_PLUGINS", "").split(","))
+
+    # Failed entries are retried with exponential backoff, and moved to the
+    # dead letter stream after max_attempts (see deadletter.py)
+    retries_key = redis_stream + ".retries"
+    dead_letter_stream = os.environ.get("DEAD_LETTER_STREAM") or redis_stream + ".dead"
+    max_attempts = int(os.environ.get("MAX_ATTEMPTS", 5))
+    retry_backoff = float(os.environ.get("RETRY_BACKOFF", 10))
+
     elastic_host = os.environ["ELASTIC_HOST"]
     if elastic_host:
         logging.info("Connecting Elasticsearch to %s", elastic_host)
@@ -464,20 +641,147 @@ def main():
     else:
         es = None
 
+    # On shutdown, finish the current message, write out pending
+    # receptions and exit. Any messages not processed yet stay in the stream
+    # and are processed on the next start.
+    shutdown_timeout = int(os.environ.get("SHUTDOWN_TIMEOUT", 20))
+    signal.signal(signal.SIGTERM, handle_shutdown_signal)
+    signal.signal(signal.SIGINT, handle_shutdown_signal)
+
+    controller = BatchController(
+        min_batch=int(os.environ.get("BATCH_SIZE_MIN", 1)),
+        max_batch=int(os.environ.get("BATCH_SIZE_MAX", 1000)),
+        max_flush_interval=float(os.environ.get("FLUSH_INTERVAL_MAX", 5)),
+        target_round_time=float(os.environ.get("TARGET_ROUND_TIME", 2)),
+    )
+    metrics_key = os.environ.get("METRICS_KEY")
+
+    # Entries that were processed, but are only removed from the stream
+    # once their receptions are written. Until then, a crash just means
+    # they are processed again on the next start.
+    processed_entries = []
+
+    def flush():
+        """Write pending receptions, then remove processed entries from the stream."""
+        if not processed_entries and not pending_receptions:
+            return
+        start = time.monotonic()
+        try:
+            flush_receptions()
+        except psycopg2.Error as ex:
+            logging.exception("Error storing receptions, will retry: %s", ex)
+            return
+        if processed_entries:
+            pipe = redis_server.pipeline()
+            for stream_name, entry_id, state in processed_entries:
+                pipe.xdel(stream_name, entry_id)
+                if state:
+                    pipe.hdel(retries_key, entry_id)
+            pipe.execute()
+            processed_entries.clear()
+        controller.observe_flush(time.monotonic() - start)
+
     messages_from = "0"
-    while True:
-        for stream_name, messages in redis_server.xread(
-                {redis_stream: messages_from}, block=60 * 1000
-        ):
-            for entry_id, message in messages:
-                from_entry_id = entry_id.decode("utf-8")
-                try:
-                    process_message(entry_id.decode("utf-8"), message)
-                    # When successful, remove from the stream
-                    redis_server.xdel(stream_name, entry_id)
-                # pylint: disable=broad-except
-                except Exception as ex:
-                    logging.exception("Error processing message: %s", ex)
+    # Time of the earliest retry of a failed entry, if any
+    next_retry = None
+    # Current pause after a transient error, or None when all is well
+    outage_backoff = None
+    while not stopping:
+        try:
+            # Processed entries are deleted from the stream (on flush), so
+            # this is the number of entries still to be processed. Failed
+            # entries (which have retry state until they are processed or
+            # dead-lettered) are left out, since they are not a backlog to
+            # catch up on, just waiting for their next attempt.
+            pipe = redis_server.pipeline()
+            pipe.xlen(redis_stream)
+            pipe.hlen(retries_key)
+            length, failed = pipe.execute()
+            failed -= sum(1 for _, _, state in processed_entries if state)
+            controller.update(max(length - len(processed_entries) - failed, 0))
+            if processed_entries and controller.should_flush():
+                flush()
+            if metrics_key:
+                redis_server.hset(metrics_key, mapping=controller.metrics())
+
+            # Do not wait for new messages beyond the next retry
+            block = 60 * 1000
+            if next_retry is not None:
+                block = max(1, min(block, int((next_retry - time.time()) * 1000)))
+
+            try:
+                waiting = True
+                streams = redis_server.xread(
+                    {redis_stream: messages_from}, count=controller.batch_size, block=block
+                )
+            except ShutdownRequested:
+                break
+            finally:
+                waiting = False
+
+            if not streams:
+                # No new messages, so start from the beginning again next
+                # time, to retry any entries that failed before. Processed
+                # entries must be removed first, or they would be read again.
+                flush()
+                if not processed_entries:
+                    messages_from = "0"
+                    next_retry = None
+
+            for stream_name, messages in streams:
+                states = get_retry_states([entry_id for entry_id, _ in messages])
+                for entry_id, message in messages:
+                    if stopping:
+                        break
+                    previous = messages_from
+                    messages_from = entry_id
+                    state = states.get(entry_id)
+                    if state and state["retry_at"] > time.time():
+                        if next_retry is None or state["retry_at"] < next_retry:
+                            next_retry = state["retry_at"]
+                        continue
+
+                    start = time.monotonic()
+                    try:
+                        process_message(entry_id.decode("utf-8"), message)
+                        # When successful, remove from the stream on the next flush
+                        processed_entries.append((stream_name, entry_id, state))
+                    except TRANSIENT_ERRORS:
+                        # Read this entry again once the outage is over
+                        messages_from = previous
+                        raise
+                    # pylint: disable=broad-except
+                    except Exception as ex:
+                        logging.exception("Error processing message: %s", ex)
+                        retry_at = record_failure(stream_name, entry_id, message, ex, state)
+                        if retry_at is not None and (next_retry is None or retry_at < next_retry):
+                            next_retry = retry_at
+                    controller.observe_message(time.monotonic() - start)
+        except TRANSIENT_ERRORS as ex:
+            outage_backoff = min(
+                outage_backoff * 2 if outage_backoff else OUTAGE_BACKOFF_MIN, OUTAGE_BACKOFF_MAX
+            )
+            logging.error("Service unavailable, pausing for %s seconds: %r", outage_backoff, ex)
+            try:
+                waiting = True
+                if not stopping:
+                    time.sleep(outage_backoff)
+            except ShutdownRequested:
+                break
+            finally:
+                waiting = False
+            continue
+
+        if outage_backoff is not None:
+            logging.info("Services available again, resuming")
+            outage_backoff = None
+
+    try:
+        flush()
+    except TRANSIENT_ERRORS as ex:
+        # Unflushed entries are processed again on the next start
+        logging.error("Could not flush on shutdown: %r", ex)
+    logging.info("Shutdown complete")
 
 
 main()
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# vim:fileencoding=utf8
+# pylint: disable=missing-docstring
+"""
+Tiered storage for raw messages.
+
+Raw messages older than ARCHIVE_AFTER_DAYS are moved in bulk from the
+rawmessage table into segment files in ARCHIVE_DIR. The rows themselves are
+kept (configs and bundles refer to them), but their raw and decoded columns
+are cleared and archive_segment is set to the name of the segment that
+holds the payload. The decoded column is not archived, since it can be
+recreated by parsing the raw payload.
+
+Each segment consists of two files:
+ - <name>.seg: A sequence of zstd-compressed blocks, each prefixed with its
+   compressed length as a 4-byte little-endian integer. A block contains up
+   to BLOCK_RECORDS records, each a RECORD_HEADER followed by the src,
+   src_id and raw bytes.
+ - <name>.idx: For each record, its id and the offset of its block in the
+   .seg file, as INDEX_ENTRY. Entries are sorted by id.
+
+Usage:
+
+    python archive.py archive
+    python archive.py replay [from_id [to_id]]
+
+Replay feeds raw messages (whether archived or not) back into the redis
+stream, to be processed again by the decoder.
+"""
+import bisect
+import logging
+import mmap
+import os
+import struct
+import sys
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse
+
+import psycopg2
+import redis
+import zstandard
+
+# id, received_from_src (unix timestamp, NaN when unknown), length of src,
+# src_id and raw
+RECORD_HEADER = struct.Struct("<qdHHI")
+BLOCK_HEADER = struct.Struct("<I")
+# id, block offset
+INDEX_ENTRY = struct.Struct("<qQ")
+
+BLOCK_RECORDS = 256
+SEGMENT_RECORDS = 100000
+COMPRESSION_LEVEL = 10
+
+
+def segment_paths(archive_dir, name):
+    base = os.path.join(archive_dir, name)
+    return base + ".seg", base + ".idx"
+
+
+def encode_record(msg_id, src, src_id, received, raw):
+    src = src.encode("utf8")
+    src_id = (src_id or "").encode("utf8")
+    raw = raw or b""
+    timestamp = received.timestamp() if received else float("nan")
+    header = RECORD_HEADER.pack(msg_id, timestamp, len(src), len(src_id), len(raw))
+    return header + src + src_id + raw
+
+
+def decode_records(block):
+    pos = 0
+    while pos < len(block):
+        msg_id, timestamp, src_len, src_id_len, raw_len = RECORD_HEADER.unpack_from(block, pos)
+        pos += RECORD_HEADER.size
+        src = block[pos:pos + src_len].decode("utf8")
+        pos += src_len
+        src_id = block[pos:pos + src_id_len].decode("utf8")
+        pos += src_id_len
+        raw = block[pos:pos + raw_len]
+        pos += raw_len
+        received = None
+        if timestamp == timestamp:  # i.e. not NaN
+            received = datetime.fromtimestamp(timestamp, timezone.utc)
+        yield {
+            "id": msg_id,
+            "src": src,
+            "src_id": src_id,
+            "received_from_src": received,
+            "raw": raw,
+        }
+
+
+def write_segment(archive_dir, rows):
+    """
+    Write the given (id, src, src_id, received_from_src, raw) rows, sorted
+    by id, to a new segment. Files are written under a temporary name and
+    only renamed once complete and synced to disk, so a segment either
+    exists completely or not at all. Returns the segment name.
+    """
+    name = "raw-{:012d}-{:012d}".format(rows[0][0], rows[-1][0])
+    seg_path, idx_path = segment_paths(archive_dir, name)
+    compressor = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL)
+
+    with open(seg_path + ".tmp", "wb") as seg, open(idx_path + ".tmp", "wb") as idx:
+        for start in range(0, len(rows), BLOCK_RECORDS):
+            block_rows = rows[start:start + BLOCK_RECORDS]
+            offset = seg.tell()
+            block = compressor.compress(b"".join(encode_record(*row) for row in block_rows))
+            seg.write(BLOCK_HEADER.pack(len(block)))
+            seg.write(block)
+            for row in block_rows:
+                idx.write(INDEX_ENTRY.pack(row[0], offset))
+        for f in (seg, idx):
+            f.flush()
+            os.fsync(f.fileno())
+
+    os.rename(seg_path + ".tmp", seg_path)
+    os.rename(idx_path + ".tmp", idx_path)
+    return name
+
+
+class SegmentIndex:
+    """Sequence view of the ids in an index file, for use with bisect."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data) // INDEX_ENTRY.size
+
+    def __getitem__(self, i):
+        return INDEX_ENTRY.unpack_from(self.data, i * INDEX_ENTRY.size)[0]
+
+    def offset(self, i):
+        return INDEX_ENTRY.unpack_from(self.data, i * INDEX_ENTRY.size)[1]
+
+
+class SegmentReader:
+    """
+    Random access to the records in a segment. The most recently
+    decompressed block is kept, so reading records in id order only
+    decompresses each block once.
+    """
+
+    def __init__(self, archive_dir, name):
+        seg_path, idx_path = segment_paths(archive_dir, name)
+        self.seg = open(seg_path, "rb")
+        with open(idx_path, "rb") as idx:
+            self.index = SegmentIndex(mmap.mmap(idx.fileno(), 0, access=mmap.ACCESS_READ))
+        self.decompressor = zstandard.ZstdDecompressor()
+        self.block_offset = None
+        self.block_records = {}
+
+    def close(self):
+        self.seg.close()
+        self.index.data.close()
+
+    def read_block(self, offset):
+        if offset != self.block_offset:
+            self.seg.seek(offset)
+            (length,) = BLOCK_HEADER.unpack(self.seg.read(BLOCK_HEADER.size))
+            block = self.decompressor.decompress(self.seg.read(length))
+            self.block_records = {r["id"]: r for r in decode_records(block)}
+            self.block_offset = offset
+        return self.block_records
+
+    def get(self, msg_id):
+        i = bisect.bisect_left(self.index, msg_id)
+        if i == len(self.index) or self.index[i] != msg_id:
+            raise KeyError(msg_id)
+        return self.read_block(self.index.offset(i))[msg_id]
+
+    def __iter__(self):
+        offset = 0
+        while True:
+            self.seg.seek(offset)
+            header = self.seg.read(BLOCK_HEADER.size)
+            if not header:
+                return
+            (length,) = BLOCK_HEADER.unpack(header)
+            yield from decode_records(self.decompressor.decompress(self.seg.read(length)))
+            offset += BLOCK_HEADER.size + length
+
+
+def archive(database_url, archive_dir, older_than):
+    """Move the payload of raw messages received before older_than to segments."""
+    conn = psycopg2.connect(database_url)
+    try:
+        while True:
+            with conn, conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT "id", "src", "src_id", "received_from_src", "raw"
+                    FROM "rawmessage"
+                    WHERE "archive_segment" IS NULL AND "received_from_src" < %s
+                    ORDER BY "id" LIMIT %s
+                """, (older_than, SEGMENT_RECORDS))
+                rows = [
+                    (msg_id, src, src_id, received, bytes(raw) if raw is not None else None)
+                    for msg_id, src, src_id, received, raw in cursor
+                ]
+                if not rows:
+                    return
+
+                name = write_segment(archive_dir, rows)
+                # If this fails, the segment is left unreferenced, and the
+                # rows will be archived again into a new segment next time
+                cursor.execute("""
+                    UPDATE "rawmessage"
+                    SET "raw" = NULL, "decoded" = NULL, "archive_segment" = %s
+                    WHERE "id" = ANY(%s)
+                """, (name, [row[0] for row in rows]))
+                logging.info("Archived %s raw messages to %s", len(rows), name)
+    finally:
+        conn.close()
+
+
+def iter_raw_messages(database_url, archive_dir, from_id=0, to_id=None):
+    """
+    Yield all raw messages in the given id range, in id order, reading
+    the payload from the database or the archive as needed.
+    """
+    conn = psycopg2.connect(database_url)
+    readers = {}
+    try:
+        with conn.cursor(name="replay") as cursor:
+            cursor.execute("""
+                SELECT "id", "src", "src_id", "received_from_src", "raw", "archive_segment"
+                FROM "rawmessage"
+                WHERE "id" >= %s AND (%s IS NULL OR "id" <= %s)
+                ORDER BY "id"
+            """, (from_id, to_id, to_id))
+            for msg_id, src, src_id, received, raw, segment in cursor:
+                if segment is None:
+                    yield {
+                        "id": msg_id,
+                        "src": src,
+                        "src_id": src_id,
+                        "received_from_src": received,
+                        "raw": bytes(raw) if raw is not None else b"",
+                    }
+                    continue
+
+                if segment not in readers:
+                    # Rows are sorted by id, so we are done with earlier segments
+                    for reader in readers.values():
+                        reader.close()
+                    readers = {segment: SegmentReader(archive_dir, segment)}
+                yield readers[segment].get(msg_id)
+    finally:
+        for reader in readers.values():
+            reader.close()
+        conn.close()
+
+
+def replay(database_url, archive_dir, redis_server, redis_stream, from_id=0, to_id=None):
+    count = 0
+    for msg in iter_raw_messages(database_url, archive_dir, from_id, to_id):
+        received = msg["received_from_src"] or datetime.now(timezone.utc)
+        redis_server.xadd(redis_stream, {
+            "payload": msg["raw"],
+            "timestamp": received.isoformat(),
+        })
+        count += 1
+    logging.info("Replayed %s raw messages", count)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    database_url = os.environ["DATABASE_URL"]
+    archive_dir = os.environ["ARCHIVE_DIR"]
+
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == "archive":
+        days = int(os.environ.get("ARCHIVE_AFTER_DAYS", 30))
+        older_than = datetime.now(timezone.utc) - timedelta(days=days)
+        os.makedirs(archive_dir, exist_ok=True)
+        archive(database_url, archive_dir, older_than)
+    elif command == "replay":
+        from_id = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+        to_id = int(sys.argv[3]) if len(sys.argv) > 3 else None
+
+        redis_url = urlparse(os.environ["REDIS_URL"])
+        redis_server = redis.Redis(
+            host=redis_url.hostname, port=redis_url.port, db=int(redis_url.path[1:] or 0)
+        )
+        replay(
+            database_url, archive_dir, redis_server, os.environ["REDIS_STREAM"],
+            from_id, to_id,
+        )
+    else:
+        print("Usage: {} archive|replay [from_id [to_id]]".format(sys.argv[0]))
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: set sw=4 sts=4 expandtab:
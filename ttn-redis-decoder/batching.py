@@ -0,0 +1,103 @@
+# vim:fileencoding=utf8
+# pylint: disable=missing-docstring
+"""
+Adaptive batching for the decoder main loop.
+
+The controller picks how many stream entries to read per round and how long
+pending batched writes (e.g. receptions) may be buffered before flushing.
+When the stream is (nearly) empty, it picks small batches and flushes right
+away, to keep latency low. When there is a backlog, it picks larger batches
+and flushes less often, for throughput. The batch size is also limited by
+the observed processing and flush times, so a single round does not take
+much longer than target_round_time (which also bounds the time needed to
+drain on shutdown). When more than one batch behind, the flush interval is
+also kept long enough that flushing takes at most FLUSH_TIME_FRACTION of
+the time.
+
+Note that only the writes done by flushing are actually batched. Each
+message is still stored (and indexed in elasticsearch) with its own
+commit, so the per-message latency bounds the throughput regardless of the
+batch size.
+"""
+import time
+
+# Weight of a new observation in the moving averages
+EWMA_WEIGHT = 0.1
+
+# When there is a backlog, spend at most this fraction of the time flushing
+FLUSH_TIME_FRACTION = 0.2
+
+
+def ewma(average, value):
+    if average is None:
+        return value
+    return average + EWMA_WEIGHT * (value - average)
+
+
+class BatchController:
+    def __init__(self, min_batch, max_batch, max_flush_interval, target_round_time):
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.max_flush_interval = max_flush_interval
+        self.target_round_time = target_round_time
+
+        self.batch_size = min_batch
+        self.flush_interval = 0.0
+        self.lag = 0
+        # Moving averages, in seconds
+        self.message_latency = None
+        self.flush_latency = None
+        self.last_flush = time.monotonic()
+
+    def observe_message(self, seconds):
+        self.message_latency = ewma(self.message_latency, seconds)
+
+    def observe_flush(self, seconds):
+        self.flush_latency = ewma(self.flush_latency, seconds)
+        self.last_flush = time.monotonic()
+
+    def should_flush(self):
+        return time.monotonic() - self.last_flush >= self.flush_interval
+
+    def update(self, lag):
+        """Pick new batch parameters, given the current stream length."""
+        self.lag = lag
+
+        size = max(lag, self.min_batch)
+        if self.message_latency:
+            # A round can include a flush, so leave time for that
+            budget = self.target_round_time - (self.flush_latency or 0)
+            size = min(size, int(budget / self.message_latency))
+        self.batch_size = max(self.min_batch, min(size, self.max_batch))
+
+        if not lag:
+            # Keeping up, so write right away
+            self.flush_interval = 0.0
+            return
+
+        # Scale the flush interval with how far behind we are, so writes
+        # are only delayed when there is a backlog to catch up on anyway
+        backlog = min(lag / self.max_batch, 1.0)
+        interval = self.max_flush_interval * backlog
+        if self.flush_latency and lag > self.batch_size:
+            # More than a single round behind, so flush no more often than
+            # needed to keep the time spent flushing below
+            # FLUSH_TIME_FRACTION
+            interval = max(
+                interval, self.flush_latency * (1 - FLUSH_TIME_FRACTION) / FLUSH_TIME_FRACTION
+            )
+        self.flush_interval = min(interval, self.max_flush_interval)
+
+    def metrics(self):
+        def ms(seconds):
+            return round(seconds * 1000, 3) if seconds is not None else ""
+
+        return {
+            "lag": self.lag,
+            "batch_size": self.batch_size,
+            "flush_interval_ms": ms(self.flush_interval),
+            "message_latency_ms": ms(self.message_latency),
+            "flush_latency_ms": ms(self.flush_latency),
+        }
+
+# vim: set sw=4 sts=4 expandtab:
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# vim:fileencoding=utf8
+# pylint: disable=missing-docstring
+"""
+Inspect and requeue messages the decoder gave up on.
+
+After MAX_ATTEMPTS failed attempts, the decoder moves a stream entry to the
+dead letter stream, along with details of the last error. Once the problem
+is fixed, they can be moved back into the normal stream to be processed
+again.
+
+Usage:
+
+    python deadletter.py list
+    python deadletter.py show <id>
+    python deadletter.py requeue <id>... | --all
+    python deadletter.py delete <id>...
+
+Here, <id> is the id of the entry in the dead letter stream, as shown by
+list.
+"""
+import os
+import sys
+from urllib.parse import urlparse
+
+import redis
+
+# Fields added by the decoder, which are removed again on requeue
+DEAD_LETTER_FIELDS = {b"entry_id", b"stream", b"attempts", b"error", b"traceback", b"failed_at"}
+
+
+def field(fields, name):
+    return fields.get(name.encode("utf8"), b"").decode("utf8", errors="replace")
+
+
+def list_entries(redis_server, dead_letter_stream):
+    for entry_id, fields in redis_server.xrange(dead_letter_stream):
+        print("{}  {}  attempts={}  original={}  {}".format(
+            entry_id.decode("utf8"),
+            field(fields, "failed_at"),
+            field(fields, "attempts"),
+            field(fields, "entry_id"),
+            field(fields, "error"),
+        ))
+
+
+def show_entry(redis_server, dead_letter_stream, entry_id):
+    entries = redis_server.xrange(dead_letter_stream, entry_id, entry_id)
+    if not entries:
+        print("No such entry: {}".format(entry_id))
+        return
+    _, fields = entries[0]
+    for name, value in sorted(fields.items()):
+        if name == b"traceback":
+            continue
+        print("{}: {}".format(name.decode("utf8"), value.decode("utf8", errors="replace")))
+    print()
+    print(field(fields, "traceback"))
+
+
+def requeue_entries(redis_server, dead_letter_stream, entry_ids):
+    for entry_id, fields in redis_server.xrange(dead_letter_stream):
+        if entry_ids is not None and entry_id.decode("utf8") not in entry_ids:
+            continue
+        original = {k: v for k, v in fields.items() if k not in DEAD_LETTER_FIELDS}
+        stream = fields[b"stream"]
+
+        pipe = redis_server.pipeline()
+        pipe.xadd(stream, original)
+        pipe.xdel(dead_letter_stream, entry_id)
+        new_id = pipe.execute()[0]
+        print("Requeued {} as {} in {}".format(
+            entry_id.decode("utf8"), new_id.decode("utf8"), stream.decode("utf8"),
+        ))
+
+
+def delete_entries(redis_server, dead_letter_stream, entry_ids):
+    for entry_id in entry_ids:
+        if redis_server.xdel(dead_letter_stream, entry_id):
+            print("Deleted {}".format(entry_id))
+        else:
+            print("No such entry: {}".format(entry_id))
+
+
+def main():
+    redis_stream = os.environ["REDIS_STREAM"]
+    dead_letter_stream = os.environ.get("DEAD_LETTER_STREAM") or redis_stream + ".dead"
+
+    redis_url = urlparse(os.environ["REDIS_URL"])
+    redis_server = redis.Redis(
+        host=redis_url.hostname, port=redis_url.port, db=int(redis_url.path[1:] or 0)
+    )
+
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    args = sys.argv[2:]
+    if command == "list":
+        list_entries(redis_server, dead_letter_stream)
+    elif command == "show" and len(args) == 1:
+        show_entry(redis_server, dead_letter_stream, args[0])
+    elif command == "requeue" and args:
+        requeue_entries(redis_server, dead_letter_stream, None if args == ["--all"] else set(args))
+    elif command == "delete" and args:
+        delete_entries(redis_server, dead_letter_stream, args)
+    else:
+        print(__doc__.strip())
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: set sw=4 sts=4 expandtab:
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+# vim:fileencoding=utf8
+# pylint: disable=missing-docstring
+"""
+Versioned schema migrations and query plan checks for the decoder database.
+
+The decoder applies pending migrations on startup. This can also be run by
+hand:
+
+    python schema.py migrate
+    python schema.py plans [node_id]
+
+The latter shows the query plans for the queries the decoder runs for every
+message, and warns about any sequential scans in them. Note that on small
+tables, the planner might prefer a sequential scan anyway, so this is mostly
+useful against a production-sized database.
+"""
+import json
+import logging
+import os
+import sys
+from datetime import datetime, timezone
+
+import psycopg2
+
+# Arbitrary key for the advisory lock held while migrating
+MIGRATION_LOCK_ID = 0x6D6A73
+
+
+class ConcurrentIndex:
+    """
+    Migration step that builds an index using CREATE INDEX CONCURRENTLY,
+    which does not block writes to the table while the index is built. This
+    cannot run inside a transaction, so it runs after the other statements
+    of the same migration were committed (so it can use e.g. columns added
+    by them).
+    """
+
+    def __init__(self, name, table, columns, where=None):
+        self.name = name
+        self.table = table
+        self.columns = columns
+        self.where = where
+
+    def apply(self, cursor):
+        cursor.execute(
+            'SELECT "indisvalid" FROM "pg_index" WHERE "indexrelid" = to_regclass(%s)',
+            ('"{}"'.format(self.name),),
+        )
+        row = cursor.fetchone()
+        if row and row[0]:
+            return
+        if row:
+            # An interrupted concurrent build leaves an invalid index behind
+            logging.info("Dropping invalid index %s", self.name)
+            cursor.execute('DROP INDEX CONCURRENTLY "{}"'.format(self.name))
+
+        logging.info("Building index %s", self.name)
+        sql = 'CREATE INDEX CONCURRENTLY "{}" ON "{}" ({})'.format(
+            self.name, self.table, self.columns,
+        )
+        if self.where:
+            sql += " WHERE " + self.where
+        cursor.execute(sql)
+
+
+def add_foreign_key(table, name, definition):
+    # ALTER TABLE has no IF NOT EXISTS for constraints
+    return """
+        DO $$ BEGIN
+            IF NOT EXISTS (SELECT 1 FROM "pg_constraint" WHERE "conname" = '{name}') THEN
+                ALTER TABLE "{table}" ADD CONSTRAINT "{name}" {definition};
+            END IF;
+        END $$
+    """.format(table=table, name=name, definition=definition)
+
+
+# Each migration is a list of SQL statements (applied in a single
+# transaction) and ConcurrentIndex steps (built after that transaction).
+# If building an index is interrupted, the whole migration is applied again
+# on the next run, so the statements of a migration with ConcurrentIndex
+# steps must be idempotent (e.g. use IF NOT EXISTS). Never modify a
+# migration once it was applied anywhere, just add a new one to the end.
+MIGRATIONS = [
+    # 1: Initial schema, exactly as previously created by Pony's
+    # create_tables=True. This uses IF NOT EXISTS, so it is a no-op for
+    # existing databases.
+    [
+        """
+        CREATE TABLE IF NOT EXISTS "rawmessage" (
+            "id" SERIAL PRIMARY KEY,
+            "src" TEXT NOT NULL,
+            "src_id" TEXT NOT NULL,
+            "received_from_src" TIMESTAMP WITH TIME ZONE,
+            "raw" BYTEA,
+            "decoded" JSONB NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS "config" (
+            "message_id" TEXT PRIMARY KEY,
+            "node_id" TEXT NOT NULL,
+            "timestamp" TIMESTAMP WITH TIME ZONE NOT NULL,
+            "src" INTEGER NOT NULL,
+            "data" JSONB NOT NULL
+        )
+        """,
+        'CREATE INDEX IF NOT EXISTS "idx_config__src" ON "config" ("src")',
+        add_foreign_key(
+            "config", "fk_config__src",
+            'FOREIGN KEY ("src") REFERENCES "rawmessage" ("id") ON DELETE CASCADE',
+        ),
+        """
+        CREATE TABLE IF NOT EXISTS "bundle" (
+            "config" TEXT NOT NULL,
+            "message_id" TEXT PRIMARY KEY,
+            "node_id" TEXT NOT NULL,
+            "timestamp" TIMESTAMP WITH TIME ZONE NOT NULL,
+            "src" INTEGER NOT NULL,
+            "data" JSONB NOT NULL
+        )
+        """,
+        'CREATE INDEX IF NOT EXISTS "idx_bundle__config" ON "bundle" ("config")',
+        'CREATE INDEX IF NOT EXISTS "idx_bundle__src" ON "bundle" ("src")',
+        add_foreign_key(
+            "bundle", "fk_bundle__config",
+            'FOREIGN KEY ("config") REFERENCES "config" ("message_id") ON DELETE CASCADE',
+        ),
+        add_foreign_key(
+            "bundle", "fk_bundle__src",
+            'FOREIGN KEY ("src") REFERENCES "rawmessage" ("id") ON DELETE CASCADE',
+        ),
+        """
+        CREATE TABLE IF NOT EXISTS "measurement" (
+            "meas_id" TEXT PRIMARY KEY,
+            "bundle" TEXT NOT NULL,
+            "config" TEXT NOT NULL,
+            "node_id" TEXT NOT NULL,
+            "channel_id" INTEGER NOT NULL,
+            "timestamp" TIMESTAMP WITH TIME ZONE NOT NULL,
+            "data" JSONB NOT NULL
+        )
+        """,
+        'CREATE INDEX IF NOT EXISTS "idx_measurement__bundle" ON "measurement" ("bundle")',
+        'CREATE INDEX IF NOT EXISTS "idx_measurement__config" ON "measurement" ("config")',
+        add_foreign_key(
+            "measurement", "fk_measurement__bundle",
+            'FOREIGN KEY ("bundle") REFERENCES "bundle" ("message_id") ON DELETE CASCADE',
+        ),
+        add_foreign_key(
+            "measurement", "fk_measurement__config",
+            'FOREIGN KEY ("config") REFERENCES "config" ("message_id") ON DELETE CASCADE',
+        ),
+    ],
+    # 2: Indexes for the per-node lookups done by the decoder and APIs and
+    # for finding previous copies of a raw message. These tables can be
+    # big, so build the indexes without blocking writes.
+    [
+        ConcurrentIndex(
+            "idx_config__node_id_timestamp", "config", '"node_id", "timestamp" DESC',
+        ),
+        ConcurrentIndex(
+            "idx_bundle__node_id_timestamp", "bundle", '"node_id", "timestamp" DESC',
+        ),
+        ConcurrentIndex(
+            "idx_measurement__node_id_timestamp", "measurement", '"node_id", "timestamp" DESC',
+        ),
+        ConcurrentIndex(
+            "idx_rawmessage__src_src_id", "rawmessage", '"src", "src_id"',
+        ),
+    ],
+    # 3: Tiered storage of raw message payloads, see archive.py
+    [
+        'ALTER TABLE "rawmessage" ADD COLUMN IF NOT EXISTS "archive_segment" TEXT',
+        # Archived messages have neither raw nor decoded
+        'ALTER TABLE "rawmessage" ALTER COLUMN "decoded" DROP NOT NULL',
+        # Lets archive() find the next batch without scanning all the
+        # already archived messages
+        ConcurrentIndex(
+            "idx_rawmessage__unarchived", "rawmessage", '"id"',
+            where='"archive_segment" IS NULL',
+        ),
+    ],
+    # 4: Gateway reception metadata, normalized out of rawmessage.decoded
+    [
+        """
+        CREATE TABLE IF NOT EXISTS "gateway" (
+            "id" SERIAL PRIMARY KEY,
+            "gtw_id" TEXT NOT NULL UNIQUE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS "reception" (
+            "src" INTEGER NOT NULL REFERENCES "rawmessage" ("id") ON DELETE CASCADE,
+            "node_id" TEXT NOT NULL,
+            "timestamp" TIMESTAMP WITH TIME ZONE NOT NULL,
+            "gateway" INTEGER NOT NULL REFERENCES "gateway" ("id"),
+            "rssi" REAL,
+            "snr" REAL,
+            "channel" SMALLINT,
+            "time" TIMESTAMP WITH TIME ZONE
+        )
+        """,
+        'CREATE INDEX IF NOT EXISTS "idx_reception__src" ON "reception" ("src")',
+        'CREATE INDEX IF NOT EXISTS "idx_reception__gateway_timestamp" '
+        'ON "reception" ("gateway", "timestamp" DESC)',
+        'CREATE INDEX IF NOT EXISTS "idx_reception__node_id_timestamp" '
+        'ON "reception" ("node_id", "timestamp" DESC)',
+    ],
+]
+
+# Queries that run for (almost) every message, or for every API request.
+# These should all be index lookups, regardless of the table size.
+HOT_QUERIES = {
+    "config for data message": """
+        SELECT * FROM "config"
+        WHERE "node_id" = %(node_id)s AND "timestamp" <= %(timestamp)s
+        ORDER BY "timestamp" DESC LIMIT 1
+    """,
+    "delete previous raw message": """
+        DELETE FROM "rawmessage" WHERE "src" = 'ttn' AND "src_id" = %(src_id)s
+    """,
+    "recent bundles for node": """
+        SELECT * FROM "bundle" WHERE "node_id" = %(node_id)s
+        ORDER BY "timestamp" DESC LIMIT 100
+    """,
+    "measurements for node and range": """
+        SELECT * FROM "measurement"
+        WHERE "node_id" = %(node_id)s AND "timestamp" <= %(timestamp)s
+          AND "timestamp" > %(timestamp)s - INTERVAL '1 day'
+        ORDER BY "timestamp" DESC
+    """,
+}
+
+
+def record_version(cursor, version):
+    cursor.execute(
+        'INSERT INTO "schema_version" ("version", "applied") VALUES (%s, %s)',
+        (version, datetime.now(timezone.utc)),
+    )
+
+
+def migrate(database_url):
+    """
+    Apply all pending migrations. Concurrent index builds can take a long
+    time on big tables, so for those, it is best to run this by hand before
+    deploying a new decoder version (the old decoder can keep running).
+    """
+    conn = psycopg2.connect(database_url)
+    # Transactions are handled explicitly below, since CREATE INDEX
+    # CONCURRENTLY cannot run inside one
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            # Prevent concurrent migrations by multiple processes. This is a
+            # session lock, so it is held across the transactions below.
+            cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS "schema_version" (
+                    "version" INTEGER PRIMARY KEY,
+                    "applied" TIMESTAMP WITH TIME ZONE NOT NULL
+                )
+            """)
+            cursor.execute('SELECT COALESCE(MAX("version"), 0) FROM "schema_version"')
+            current = cursor.fetchone()[0]
+
+            for version, steps in enumerate(MIGRATIONS, start=1):
+                if version <= current:
+                    continue
+                logging.info("Applying schema migration %s", version)
+                indexes = [step for step in steps if isinstance(step, ConcurrentIndex)]
+
+                cursor.execute("BEGIN")
+                try:
+                    for step in steps:
+                        if not isinstance(step, ConcurrentIndex):
+                            cursor.execute(step)
+                    if not indexes:
+                        record_version(cursor, version)
+                except psycopg2.Error:
+                    cursor.execute("ROLLBACK")
+                    raise
+                cursor.execute("COMMIT")
+
+                if indexes:
+                    for index in indexes:
+                        index.apply(cursor)
+                    # Only now, so an interrupted build is retried next time
+                    record_version(cursor, version)
+    finally:
+        conn.close()
+
+
+def find_seq_scans(plan):
+    if plan.get("Node Type") == "Seq Scan":
+        yield plan["Relation Name"]
+    for subplan in plan.get("Plans", []):
+        yield from find_seq_scans(subplan)
+
+
+def check_plans(database_url, node_id=None):
+    """
+    Print the plan for each of the HOT_QUERIES. Returns the number of
+    queries that need a sequential scan.
+    """
+    conn = psycopg2.connect(database_url)
+    problems = 0
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT "node_id", "timestamp" FROM "config" LIMIT 1')
+            row = cursor.fetchone()
+            params = {
+                "node_id": node_id or (row[0] if row else ""),
+                "timestamp": row[1] if row else datetime.now(timezone.utc),
+                "src_id": "0-0",
+            }
+
+            for name, query in HOT_QUERIES.items():
+                # Plain EXPLAIN does not run the query, so this is also
+                # safe for the DELETE
+                cursor.execute("EXPLAIN (FORMAT JSON) " + query, params)
+                plan = cursor.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                plan = plan[0]["Plan"]
+                cursor.execute("EXPLAIN " + query, params)
+                print("== {} (estimated cost {})".format(name, plan["Total Cost"]))
+                for (line,) in cursor.fetchall():
+                    print("   " + line)
+                for table in find_seq_scans(plan):
+                    print("WARNING: sequential scan on {}".format(table))
+                    problems += 1
+        conn.rollback()
+    finally:
+        conn.close()
+    return problems
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    database_url = os.environ["DATABASE_URL"]
+
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == "migrate":
+        migrate(database_url)
+    elif command == "plans":
+        node_id = sys.argv[2] if len(sys.argv) > 2 else None
+        sys.exit(1 if check_plans(database_url, node_id) else 0)
+    else:
+        print("Usage: {} migrate|plans [node_id]".format(sys.argv[0]))
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: set sw=4 sts=4 expandtab:
@@ -5,6 +5,7 @@
 from datetime import datetime, timezone
 import logging
 import os
+import signal
 from urllib.parse import urlparse
 
 import paho.mqtt.client as mqtt
@@ -49,7 +50,9 @@ def main():
     access_key = get_env_or_file("TTN_ACCESS_KEY")
     ttn_host = os.environ.get("TTN_HOST", "eu.thethings.network")
     ca_cert_path = os.environ.get("TTN_CA_CERT_PATH", "mqtt-ca.pem")
-    ttn_port = 8883
+    # An empty TTN_CA_CERT_PATH disables TLS, e.g. to connect to a local
+    # mosquitto for load testing
+    ttn_port = int(os.environ.get("TTN_PORT", 8883 if ca_cert_path else 1883))
 
     redis_url = urlparse(os.environ["REDIS_URL"])
     logging.info(
@@ -64,9 +67,24 @@ def main():
     mqtt_client.on_connect = on_connect
     mqtt_client.on_message = on_message
     mqtt_client.username_pw_set(app_id, password=access_key)
-    mqtt_client.tls_set(ca_cert_path)
+    if ca_cert_path:
+        mqtt_client.tls_set(ca_cert_path)
     mqtt_client.connect(ttn_host, port=ttn_port)
+
+    # Messages are handled synchronously from within the network loop, so
+    # after disconnecting, loop_forever() returns only after the current
+    # message was added to redis.
+    def on_shutdown_signal(signum, frame):
+        logging.info("Received signal %s, shutting down", signum)
+        # If the pending work cannot be finished in time, SIGALRM will kill us
+        signal.alarm(int(os.environ.get("SHUTDOWN_TIMEOUT", 20)))
+        mqtt_client.disconnect()
+
+    signal.signal(signal.SIGTERM, on_shutdown_signal)
+    signal.signal(signal.SIGINT, on_shutdown_signal)
+
     mqtt_client.loop_forever()
+    logging.info("Shutdown complete")
 
 
 main()